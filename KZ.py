@@ -2,6 +2,7 @@
 
 import os
 import re
+import argparse
 import shutil
 import pandas as pd
 from datetime import datetime
@@ -10,6 +11,9 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 import sourmash
 import subprocess
+from references import ReferenceRegistry
+from scheduler import CPUScheduler
+from datasets import DatasetStore
 
 class KZ_Pipeline():
 
@@ -17,7 +21,8 @@ class KZ_Pipeline():
     ## ---- CLASS START
     def __init__(self):
         self.time = datetime.now().strftime('%Y-%m-%d_%H:%M')
-        self.threads = os.cpu_count()
+        # Threads for external tools are leased from a host-wide budget
+        self.scheduler = CPUScheduler()
 
         # Create needed folders
         folders = ['res','tmp']
@@ -30,30 +35,18 @@ class KZ_Pipeline():
     def set_reference(self, reference):
         self.reference = reference
         
-        # Set references and metadata for TBEV
-        if self.reference == 'TBEV':
-            self.ref_file = 'res/TBEV_reference.fasta'
-            self.ref_file_gb = 'res/TBEV_reference.gb'
-            self.mmi_file = 'res/TBEV_reference.mmi'
-            self.metadata_file = 'res/TBEV_metadata.tsv'
-            self.ncbidata_file = 'res/TBEV_NCBI_metadata.tsv'
-            self.export_fasta = 'tmp/TBEV.fasta'
-            self.export_tsv = 'tmp/TBEV_metadata.tsv'
-        # Set references and metadata for CCHF
-        elif self.reference == 'CCHF':
-            self.ref_file = 'res/CCHF_reference.fasta'
-            self.ref_file_gb = 'res/CCHF_reference.gb'
-            self.mmi_file = 'res/CCHF_reference.mmi'
-            self.metadata_file = 'res/CCHF_metadata.tsv'
-            self.ncbidata_file = 'res/CCHF_NCBI_metadata.tsv'
-            self.export_fasta = 'tmp/CCHF.fasta'
-            self.export_tsv = 'tmp/CCHF_metadata.tsv'
-        else:
-            raise Exception("Need the reference to be either TBEF or CCHF")
-        
-        # if you haven't indexed the reference, do so
-        if not os.path.exists(self.mmi_file):
-            os.system(f"minimap2 -d {self.mmi_file} {self.ref_file}")
+        # Look up reference files from the registry, artifacts are checked against res/references.lock.json
+        entry = ReferenceRegistry().get(self.reference)
+        self.reference_entry = entry
+        self.ref_file = entry['fasta']
+        self.ref_file_gb = entry['genbank']
+        self.mmi_file = entry['mmi']
+        self.ncbidata_file = entry['ncbi']
+        self.auspice_config = entry['auspice_config']
+        self.shortest_segment_only = entry['shortest_segment_only']
+        self.metadata_file = f'res/{self.reference}_metadata.tsv'
+        self.export_fasta = f'tmp/{self.reference}.fasta'
+        self.export_tsv = f'tmp/{self.reference}_metadata.tsv'
 
         # Load Metadata
         if os.path.exists(self.metadata_file):
@@ -113,6 +106,18 @@ class KZ_Pipeline():
                 )
         return seqs
     
+    def get_records(self, names, include_ncbi=False):
+        # Full rows, sequences included, for the named records
+        df = pd.concat([self.metadata, self.ncbidata]) if include_ncbi else self.metadata
+        return df[df['name'].astype(str).isin(names)].reset_index(drop=True)
+
+    def delete_records(self, names):
+        # Only user uploaded records can be deleted, returns the names that were left alone
+        user_names = set(self.metadata['name'].astype(str))
+        self.metadata = self.metadata[~self.metadata['name'].astype(str).isin(names)]
+        self.metadata.to_csv(self.metadata_file, sep='\t', index=False)
+        return [n for n in names if n not in user_names]
+
     def create_export_tmp(self):
         fasta = self.seqs_from_df(self.metadata[['name','seq']])
         SeqIO.write(fasta, self.export_fasta, 'fasta')
@@ -123,6 +128,10 @@ class KZ_Pipeline():
 
         return [self.export_fasta, self.export_tsv]
 
+    def queue_report(self):
+        # Seconds each stage waited for CPUs in this run
+        return ', '.join(f'{stage} {wait:.1f}s' for stage, wait in self.scheduler.waits.items())
+
     ######################################################################################################################
     ## ---- MAKE ASSEMBLY FROM UPLOADED FASTQ. 
     ## ---- WRITE OUT METADATA AND FINAL ASSEMBLY TO METADATA TABLE
@@ -135,7 +144,8 @@ class KZ_Pipeline():
 
         #### Create Assembly
         # Minimap2 to map the sequences to the input indexed sam
-        os.system(f"minimap2 -ax map-ont -t {self.threads} {self.mmi_file} {input_fastq} > {sam_file}")
+        with self.scheduler.lease('minimap2') as lease:
+            os.system(f"{lease.prefix}minimap2 -ax map-ont -t {lease.threads} {self.mmi_file} {input_fastq} > {sam_file}")
         # samtools to convert sam to bam and sort
         os.system(f"samtools view -bS {sam_file} | samtools sort -o {bam_file}")
         # bcf tools to convert the sorted bam to a vcf.gz
@@ -145,8 +155,8 @@ class KZ_Pipeline():
         # get the consensus assembly from the vcf
         os.system(f"bcftools consensus -f {self.ref_file} {vcf_file} > tmp/consensus.fasta")
 
-        if self.reference == 'CCHF':
-            # eliminate all but the shortest fasta entry (L Segment)
+        if self.shortest_segment_only:
+            # eliminate all but the shortest fasta entry (S Segment)
             records = list(SeqIO.parse('tmp/consensus.fasta', "fasta"))
             # Find the shortest entry
             shortest_record = min(records, key=lambda x: len(x.seq))
@@ -229,13 +239,14 @@ class KZ_Pipeline():
         # Write out to temp fasta file
         SeqIO.write(seqs, tmp_alignment, 'fasta')
         
-        os.system(f"augur align \
-                  --sequences {tmp_alignment} \
-                  --reference-sequence {self.ref_file_gb} \
-                  --fill-gaps \
-                  --output tmp/msa.fasta \
-                  --nthreads {self.threads}"
-                  )
+        with self.scheduler.lease('augur_align') as lease:
+            os.system(f"{lease.prefix}augur align \
+                      --sequences {tmp_alignment} \
+                      --reference-sequence {self.ref_file_gb} \
+                      --fill-gaps \
+                      --output tmp/msa.fasta \
+                      --nthreads {lease.threads}"
+                      )
     
     ######################################################################################################################
     ## ---- RUN AUGUR PIPELINE
@@ -249,20 +260,21 @@ class KZ_Pipeline():
         ancestral = 'tmp/augur_ancestral.json'
         translate = 'tmp/augur_muts.json'
         traits = 'tmp/augur_traits.json'
-        config = 'res/auspice_config.json'
+        config = self.auspice_config
         auspice = 'tmp/augur_auspice.json'
 
         # Write out our metadata
         input_df.to_csv(metadata, sep='\t', index=False)
     
         # Build Tree
-        os.system(f"augur tree \
-                  --alignment {alignment} \
-                  --method iqtree \
-                  --output {tree} \
-                  --nthreads {self.threads} \
-                  --tree-builder-args='-seed 123'"
-                  )
+        with self.scheduler.lease('augur_tree') as lease:
+            os.system(f"{lease.prefix}augur tree \
+                      --alignment {alignment} \
+                      --method iqtree \
+                      --output {tree} \
+                      --nthreads {lease.threads} \
+                      --tree-builder-args='-seed 123'"
+                      )
         # Augur Refine
         os.system(f"augur refine \
                   --tree {tree} \
@@ -298,6 +310,7 @@ class KZ_Pipeline():
                   --metadata {metadata} \
                   --node-data {node_data} {traits} {ancestral} {translate} \
                   --auspice-config {config} \
+                  --include-root-sequence \
                   --output {auspice}"
                   )
         
@@ -314,16 +327,22 @@ class KZ_Pipeline():
         genbank_labels['type'] = 'Genbank'
         labels = pd.concat([input_labels,genbank_labels])
 
-        # Get our sequences
-        seqs = self.seqs_from_df(self.ncbidata)
-        seqs = self.seqs_from_df(input_df) + seqs
-
         sketches = []
         # Add our sequences
-        for s in seqs:
+        for s in self.seqs_from_df(input_df):
             mh = sourmash.MinHash(0, ksize=args['klen'], scaled=args['scale'], track_abundance=args['abundance'])
             mh.add_sequence(str(s.seq),force=True)
             sketches.append(mh)
+
+        # Genbank sketches are prebuilt by `python KZ.py build`, only sketch them here for non-default args
+        registry = ReferenceRegistry()
+        if args == registry.sketch_params:
+            sketches += registry.load_sketches(self.reference_entry, self.ncbidata['name'])
+        else:
+            for s in self.seqs_from_df(self.ncbidata):
+                mh = sourmash.MinHash(0, ksize=args['klen'], scaled=args['scale'], track_abundance=args['abundance'])
+                mh.add_sequence(str(s.seq),force=True)
+                sketches.append(mh)
         
         ignore_abund = not args['abundance']
         sim_matrix = sourmash.compare.compare_all_pairs(sketches, ignore_abund)
@@ -331,12 +350,26 @@ class KZ_Pipeline():
         return labels, sim_matrix
 
     ######################################################################################################################
-    ## ---- VIEW NEXTSTRAIN
-    def view_nextstrain(self):
-        os.system(f"nextstrain view tmp/augur_auspice.json")
+    ## ---- PUBLISH NEXTSTRAIN
+    ## ---- COPY THE BUILD OUT OF tmp INTO THE DATASET DIRECTORY SERVED BY THE VIEWER
+    def publish_nextstrain(self):
+        store = DatasetStore()
+        name = store.publish(self.reference, 'tmp/augur_auspice.json')
+        viewer_running = store.ensure_viewer()
+        return store.url(name), viewer_running
 
 
 ###############################################################################
 if __name__ == "__main__":
 
-    print('Run steamlit application to work with KZ nextstrain workflow\nconda activate KZ_augur\nstreamlit run app.py')
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build', help='Build and checksum reference indexes and sketches from res/references.json')
+    build_parser.add_argument('references', nargs='*', help='References to build, defaults to all')
+    build_parser.add_argument('--force', action='store_true', help='Rebuild derived files even if they are up to date')
+    cli_args = parser.parse_args()
+
+    if cli_args.command == 'build':
+        ReferenceRegistry().build(cli_args.references, force=cli_args.force)
+    else:
+        print('Run steamlit application to work with KZ nextstrain workflow\nconda activate KZ_augur\nstreamlit run app.py')
\ No newline at end of file
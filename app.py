@@ -6,6 +6,8 @@ import altair as alt
 import umap
 import shutil
 from KZ import KZ_Pipeline
+from references import ReferenceRegistry
+from datasets import DatasetStore
 import subprocess
 import webbrowser
 import os
@@ -51,7 +53,7 @@ def file_uploader():
     file = st.file_uploader("Choose a fastq file", type=["fastq","fq"])     
     
     # Reference Selector
-    reference = st.selectbox("Select Reference", ['','CCHF','TBEV'])
+    reference = st.selectbox("Select Reference", [''] + ReferenceRegistry().names())
 
     if reference != '':
 
@@ -122,6 +124,7 @@ def file_uploader():
             st.write('Average Quality: ' + str(quality))
             st.write('Average Coverage: ' + str(average_coverage))
             st.write('Average SNP Quality: ' + str(average_snp_quality))
+            st.write('CPU Queue Wait: ' + run.queue_report())
             st.write('Generating Coverage Plot...' )
                         
             plot_df = pd.DataFrame([x.split('\t') for x in coverage_data], columns=['Ref', 'Pos', 'Depth'])
@@ -141,77 +144,175 @@ def file_uploader():
             # Display the chart in Streamlit
             st.altair_chart(chart)
 
+######################################################################################################################
+# Record Browser
+# Shows one page of metadata at a time (never the seq column) and keeps the selection in session state by record name
+BROWSER_COLUMNS = ['name', 'date', 'length', 'country', 'isolation_source', 'host', 'desc', 'subtype']
+
+def record_browser(df, key, default_include=True, allow_delete=False):
+    columns = [c for c in BROWSER_COLUMNS if c in df.columns]
+    names = df['name'].astype(str).tolist()
+
+    # Selection state, new records pick up the default Include value the first time they are seen
+    state = st.session_state.setdefault(key, {'seen': set(), 'include': set(), 'delete': set(), 'version': 0})
+    new_names = set(names) - state['seen']
+    state['seen'] |= new_names
+    if default_include:
+        state['include'] |= new_names
+    # Forget records that left the table, so they get the default again if they come back
+    state['seen'] &= set(names)
+    state['include'] &= set(names)
+    state['delete'] &= set(names)
+
+    # Filter and sort server side
+    col1, col2, col3 = st.columns([2, 1, 1])
+    with col1:
+        query = st.text_input("Filter records", key=f'{key}_query')
+    with col2:
+        sort_column = st.selectbox("Sort by", columns, key=f'{key}_sort')
+    with col3:
+        descending = st.checkbox("Descending", key=f'{key}_descending')
+
+    view = df[columns].copy()
+    view['name'] = view['name'].astype(str)
+    if query:
+        mask = view.astype(str).apply(lambda c: c.str.contains(query, case=False, regex=False)).any(axis=1)
+        view = view[mask]
+    view = view.sort_values(sort_column, ascending=not descending, kind='stable', na_position='last',
+                            key=lambda c: c if pd.api.types.is_numeric_dtype(c) else c.astype(str))
+
+    # Paginate
+    col1, col2 = st.columns(2)
+    with col1:
+        page_size = st.selectbox("Records per page", [25, 50, 100], key=f'{key}_page_size')
+    pages = max(1, -(-len(view) // page_size))
+    with col2:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key=f'{key}_page')
+    page_df = view.iloc[(page - 1) * page_size:page * page_size]
+    page_df.insert(0, 'Include', page_df['name'].isin(state['include']))
+    if allow_delete:
+        page_df.insert(0, 'Delete', page_df['name'].isin(state['delete']))
+
+    # The editor key changes with the view, so edits made on one page are never replayed onto another
+    editor_key = f"{key}_editor_{state['version']}_{query}_{sort_column}_{descending}_{page_size}_{page}"
+    edited_df = st.data_editor(page_df, key=editor_key, hide_index=True, disabled=columns)
+
+    for _, row in edited_df.iterrows():
+        if row['Include']:
+            state['include'].add(row['name'])
+        else:
+            state['include'].discard(row['name'])
+        if allow_delete:
+            if row['Delete']:
+                state['delete'].add(row['name'])
+            else:
+                state['delete'].discard(row['name'])
+
+    # Bulk selection over everything matching the filter, not just the current page
+    def set_include(selected):
+        if selected:
+            state['include'] |= set(view['name'])
+        else:
+            state['include'] -= set(view['name'])
+        state['version'] += 1
+
+    col1, col2, col3 = st.columns([1, 1, 2])
+    with col1:
+        st.button("Include all shown", key=f'{key}_include_all', on_click=set_include, args=(True,))
+    with col2:
+        st.button("Exclude all shown", key=f'{key}_exclude_all', on_click=set_include, args=(False,))
+    with col3:
+        st.caption(f"{len(state['include'])} of {len(names)} records included, {len(view)} shown by filter")
+
+    include = [n for n in names if n in state['include']]
+    delete = [n for n in names if n in state['delete']]
+    return include, delete
+
+
 ######################################################################################################################
 # Run Nextstrain
 def run_nextstrain():
     st.markdown("## Run Nextstrain")
 
-    # Select dropdown for CCHF and TBEV
-    reference = st.selectbox("Select Reference", ['CCHF','TBEV'])
+    # Select dropdown for the references in res/references.json
+    reference = st.selectbox("Select Reference", ReferenceRegistry().names())
     # Start Pipeline and insert reference type
     run = KZ_Pipeline()
     run.set_reference(reference)
 
-    # Build out editable table
-    if st.checkbox("Use NCBI Data"):
-        df1 = run.metadata
-        df2 = run.ncbidata
-        df = pd.concat([df1,df2]).reset_index(drop=True)
+    # Browse records, sequences stay server side until Submit
+    use_ncbi = st.checkbox("Use NCBI Data")
+    if use_ncbi:
+        df = pd.concat([run.metadata, run.ncbidata]).reset_index(drop=True)
     else:
         df = run.metadata
 
     if len(df) > 0:
-        df['Include'] = True
-        df['Delete'] = False  # Column to select records for deletion
-        edited_df = df[['Delete', 'Include', 'name', 'date', 'length', 'country', 'isolation_source', 'host', 'desc', 'subtype']]
-        edited_df = st.data_editor(df, disabled=('name', 'date', 'length', 'country', 'isolation_source', 'host', 'desc','seq','subtype'))
-
-        # Delete selected records
-        if st.button("Delete Selected Records"):
-            names_to_keep = edited_df[edited_df['Delete'] == False]['name'].tolist()
-            df = df[df['name'].isin(names_to_keep)]
-            run.metadata = df  # Update the metadata DataFrame
-
-            # Write changes back to the file
-            df.to_csv(run.metadata_file, sep='\t', index=False)
-            st.success("Selected records deleted and metadata updated.")
-            if st.button("Click to update dataframe"):
-                edited_df['Delete']=False
-
-        # Submit Changes. Build New DF and Run Nextstrain
+        include, delete = record_browser(df, key=f'nextstrain_{reference}', allow_delete=True)
+
+        # Delete selected records, as a callback so the table is redrawn without them
+        def delete_selected():
+            state = st.session_state[f'nextstrain_{reference}']
+            state['not_deleted'] = run.delete_records(delete)
+            state['delete'] = set()
+            # Rows shift up after a delete, a new editor key stops old edits landing on other records
+            state['version'] += 1
+        st.button("Delete Selected Records", on_click=delete_selected)
+
+        not_deleted = st.session_state[f'nextstrain_{reference}'].pop('not_deleted', [])
+        if len(not_deleted) > 0:
+            st.warning('NCBI records can not be deleted, these were kept: ' + ', '.join(not_deleted))
+
+        # Submit Changes. Fetch the included records and Run Nextstrain
         if st.button("Submit"):
-            include_indexes = edited_df.loc[edited_df['Include'] == True].index.values.tolist()
-            new_df = df.iloc[include_indexes]
+            new_df = run.get_records(include, include_ncbi=use_ncbi)
 
             if len(new_df) > 3:
                 st.write('Creating Augur Alignment...')
                 run.create_msa(new_df[['name', 'desc', 'seq']])
                 st.write('Building trees and node data...')
                 run.process_augur(new_df[['name', 'date', 'country', 'isolation_source', 'host', 'subtype']])
-                st.write('Passing data to nextstrain...')
-                run.view_nextstrain()
+                st.write('CPU Queue Wait: ' + run.queue_report())
+                st.write('Publishing build to nextstrain...')
+                url, viewer_running = run.publish_nextstrain()
+                st.markdown(f'Done! [Open build in nextstrain]({url})')
+                if not viewer_running:
+                    st.warning('The nextstrain viewer could not be started, check that `nextstrain` is installed.')
             else:
                 st.write('You need more than 3 uploaded/selected to run nextstrain.')
 
     else:
         st.write('No files added.')
 
+    # Past builds stay published, link to them rather than rebuilding
+    builds = DatasetStore().list(reference)
+    if len(builds) > 0:
+        st.markdown("#### Previous Builds")
+        build = st.selectbox("Build", builds, format_func=lambda b: b['build'])
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Start nextstrain viewer"):
+                if not DatasetStore().ensure_viewer():
+                    st.warning('The nextstrain viewer could not be started, check that `nextstrain` is installed.')
+            st.markdown(f"[Open {build['build']} in nextstrain]({build['url']})")
+        with col2:
+            with open(build['gzip'], 'rb') as f:
+                st.download_button("Download build", f, file_name=os.path.basename(build['gzip']))
+
 
 ######################################################################################################################
 # Run Embedding
 def run_embedding():
     st.markdown("## Run Embedding")
 
-    # Select dropdown for CCHF and TBEV
-    reference = st.selectbox("Select Reference", ['CCHF','TBEV'])
+    # Select dropdown for the references in res/references.json
+    reference = st.selectbox("Select Reference", ReferenceRegistry().names())
     # Start Pipeline and insert reference type
     run = KZ_Pipeline()
     run.set_reference(reference)
 
-    # Get our dataframe but it in an editable table
-    edited_df = run.metadata
-    edited_df['Include'] = True
-    edited_df = st.data_editor(edited_df, disabled=('name','date','length','country','isolation_source','host','desc','seq','subtype'))
+    # Browse uploaded records
+    include, _ = record_browser(run.metadata, key=f'embedding_{reference}')
 
     # Selector controls for graph
     col1, col2 = st.columns(2)
@@ -227,15 +328,11 @@ def run_embedding():
 
     # Submit Changes. Build new DF and Run Embedding
     if st.button("Submit"):
-        include_indexs = edited_df.loc[edited_df['Include']==True].index.values.tolist()
-        new_df = run.metadata.iloc[include_indexs]
+        new_df = run.get_records(include)
         new_df['type'] = 'Project Created'
 
-        args = {
-            'klen':         11,
-            'scale':        1,
-            'abundance':    False,
-        }
+        # Same params as the prebuilt NCBI sketches, so they can be reused
+        args = ReferenceRegistry().sketch_params
 
         @st.cache_data
         def compute_umap_embedding(data):
@@ -278,50 +375,36 @@ def run_embedding():
 # Export
 def run_export():
 
-    st.write('Click to export all CCHF NCBI and submitted records')
-    if st.button("Export all CCHF"):
-        run1 = run = KZ_Pipeline()
-        run1.clean() # Remove everything in the tmp directory
-        run1.set_reference('CCHF')
-        files = run1.create_export_tmp()
-        archive_name = f'tmp/KZ_archive_{run1.time}.zip'
-
-        with zipfile.ZipFile(archive_name,'w') as zipf:
-            for file in files:
-                zipf.write(file, arcname=file.split('/')[-1])
-    
-        with open(archive_name, 'rb') as f:
-            st.download_button("Download Zip", f, file_name="CCHF_archive.zip")
-    
-    st.write('Click to export all TBEV NCBI and submitted records')
-    if st.button("Export all TBEV"):
-        run2 = run = KZ_Pipeline()
-        run2.clean() # Remove everything in the tmp directory
-        run2.set_reference('TBEV')
-        files = run2.create_export_tmp()
-        archive_name = f'tmp/KZ_archive_{run2.time}.zip'
-        
-        with zipfile.ZipFile(archive_name,'w') as zipf:
-            for file in files:
-                zipf.write(file, arcname=file.split('/')[-1])
-    
-        with open(archive_name, 'rb') as f:
-            st.download_button("Download Zip", f, file_name="TBEV_archive.zip")
-        
-    
-    
+    references = ReferenceRegistry().names()
+    for reference in references:
+        st.write(f'Click to export all {reference} NCBI and submitted records')
+        if st.button(f"Export all {reference}"):
+            run = KZ_Pipeline()
+            run.clean() # Remove everything in the tmp directory
+            run.set_reference(reference)
+            files = run.create_export_tmp()
+            archive_name = f'tmp/KZ_archive_{run.time}.zip'
+
+            with zipfile.ZipFile(archive_name,'w') as zipf:
+                for file in files:
+                    zipf.write(file, arcname=file.split('/')[-1])
+
+            with open(archive_name, 'rb') as f:
+                st.download_button("Download Zip", f, file_name=f"{reference}_archive.zip")
+
     st.write('Click to export select uploaded records. Folder will contain the assembled consensus sequences in fasta format')
-    df1 = pd.read_table('res/TBEV_metadata.tsv')
-    df2 = pd.read_table('res/CCHF_metadata.tsv')
-    
+    metadata_files = [f'res/{reference}_metadata.tsv' for reference in references]
+    metadata_files = [f for f in metadata_files if os.path.exists(f)]
+    if len(metadata_files) == 0:
+        st.write('No files added.')
+        return
+
     # Concatenate the DataFrames
-    df = pd.concat([df1,df2]).reset_index(drop=True)
-    edited_df = df[['name', 'date', 'length', 'country', 'isolation_source', 'host', 'desc', 'seq', 'subtype']]
-    edited_df['Include']=False
-    edited_df = st.data_editor(edited_df, disabled=('name', 'date', 'length', 'country', 'isolation_source', 'host', 'desc','seq', 'subtype'))
+    df = pd.concat([pd.read_table(f) for f in metadata_files]).reset_index(drop=True)
+    include, _ = record_browser(df, key='export', default_include=False)
     
     if st.button("Export select sequences"):
-        selected_df = edited_df[edited_df['Include']]
+        selected_df = df[df['name'].astype(str).isin(include)]
         temp_dir = 'tmp_export'
         os.makedirs(temp_dir, exist_ok=True)
         archive_name = f'{temp_dir}/KZ_selected_records.zip'
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import uuid
+import gzip
+import glob
+import time
+import socket
+import fcntl
+import shutil
+import subprocess
+from datetime import datetime
+
+# brotli is optional, builds are always published with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DATASET_DIR = os.environ.get('KZ_DATASET_DIR', 'datasets')
+VIEWER_PORT = int(os.environ.get('KZ_VIEWER_PORT', 4000))
+VIEWER_STARTUP_SECONDS = 60
+SIDECARS = ['root-sequence', 'tip-frequencies']
+
+# Build ids never contain underscores, so a reference name may
+BUILD_PATTERN = re.compile(r'^KZ_(?P<reference>.+)_(?P<build>\d{4}-\d{2}-\d{2}-\d{6}-[0-9a-f]+)$')
+
+
+class DatasetStore():
+
+    ######################################################################################################################
+    ## ---- CLASS START
+    def __init__(self, dataset_dir=DATASET_DIR, port=VIEWER_PORT):
+        self.dataset_dir = dataset_dir
+        self.port = port
+        self.pid_file = os.path.join(self.dataset_dir, '.viewer.pid')
+        self.log_file = os.path.join(self.dataset_dir, '.viewer.log')
+
+        if not os.path.exists(self.dataset_dir):
+            os.makedirs(self.dataset_dir)
+
+    ######################################################################################################################
+    ## ---- PUBLISH AN AUGUR EXPORT AS A VERSIONED DATASET
+    # Auspice turns underscores into url path parts, so KZ_TBEV_<build> is served at /KZ/TBEV/<build>
+    def publish(self, reference, auspice_file):
+        # Random suffix so two sessions publishing in the same second get separate builds
+        build = f"{datetime.now().strftime('%Y-%m-%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        name = f'KZ_{reference}_{build}'
+        source_prefix = auspice_file[:-len('.json')]
+
+        # Sidecars first and the main json last, so the viewer never lists a half written build
+        for sidecar in SIDECARS:
+            source = f'{source_prefix}_{sidecar}.json'
+            if os.path.exists(source):
+                self.write(source, f'{name}_{sidecar}.json')
+        self.write(auspice_file, f'{name}.json')
+
+        return name
+
+    def write(self, source, filename):
+        target = os.path.join(self.dataset_dir, filename)
+        tmp = f'{uuid.uuid4().hex}.tmp'
+        with open(source, 'rb') as f:
+            data = f.read()
+
+        # Precompressed copies for download
+        with gzip.open(f'{target}.gz.{tmp}', 'wb') as f:
+            f.write(data)
+        os.replace(f'{target}.gz.{tmp}', f'{target}.gz')
+        if brotli is not None:
+            with open(f'{target}.br.{tmp}', 'wb') as f:
+                f.write(brotli.compress(data))
+            os.replace(f'{target}.br.{tmp}', f'{target}.br')
+
+        shutil.copyfile(source, f'{target}.{tmp}')
+        os.replace(f'{target}.{tmp}', target)
+
+    ######################################################################################################################
+    ## ---- LIST PUBLISHED BUILDS, NEWEST FIRST
+    def list(self, reference=None):
+        builds = []
+        for path in glob.glob(os.path.join(self.dataset_dir, 'KZ_*.json')):
+            # Sidecars and anything not named like a published build are skipped
+            name = os.path.basename(path)[:-len('.json')]
+            match = BUILD_PATTERN.match(name)
+            if match is None:
+                continue
+            build_reference, build = match.group('reference'), match.group('build')
+            if reference is not None and build_reference != reference:
+                continue
+            builds.append({
+                'name':         name,
+                'reference':    build_reference,
+                'build':        build,
+                'url':          self.url(name),
+                'gzip':         f'{path}.gz',
+            })
+        return sorted(builds, key=lambda b: b['build'], reverse=True)
+
+    def url(self, name):
+        return f"http://localhost:{self.port}/{name.replace('_', '/')}"
+
+    ######################################################################################################################
+    ## ---- ONE LONG LIVED VIEWER FOR THE WHOLE DATASET DIRECTORY
+    # The viewer reads the directory on every request, so new builds show up without a restart.
+    # Returns whether a viewer is running, False if it could not be started.
+    def ensure_viewer(self):
+        with open(f'{self.pid_file}.lock', 'w') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+
+            if self.viewer_running():
+                return True
+
+            try:
+                with open(self.log_file, 'a') as log:
+                    process = subprocess.Popen(
+                        ['nextstrain', 'view', '--port', str(self.port), self.dataset_dir],
+                        stdout=log,
+                        stderr=subprocess.STDOUT,
+                        start_new_session=True,
+                    )
+            except FileNotFoundError:
+                print('Could not start the nextstrain viewer, `nextstrain` is not on the PATH')
+                return False
+            with open(self.pid_file, 'w') as f:
+                f.write(str(process.pid))
+            return True
+
+    def viewer_running(self):
+        if not os.path.exists(self.pid_file):
+            return False
+        with open(self.pid_file) as f:
+            pid = f.read().strip()
+        if not pid.isdigit() or int(pid) <= 0:
+            return False
+        pid = int(pid)
+
+        # Reap the viewer if this process started it and it has exited, a zombie still answers os.kill
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                return False
+        except ChildProcessError:
+            pass
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+
+        # A live pid may have been reused by another program, so the viewer must also answer on its port.
+        # Give a freshly started viewer time to bind before deciding it failed.
+        if self.port_open():
+            return True
+        return time.time() - os.path.getmtime(self.pid_file) < VIEWER_STARTUP_SECONDS
+
+    def port_open(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(0.5)
+            return s.connect_ex(('localhost', self.port)) == 0
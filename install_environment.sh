@@ -5,3 +5,6 @@ tar -xzf kz.tar.gz -C kz_env
 echo "Finished unpacking kz.tar.gz"
 echo "run 'source kz_env/bin/activate' in terminal to launch environment"
 echo "run 'source kz_env/bin/deactivate' in terminal to leave environment"
+echo "Building reference indexes and sketches"
+source kz_env/bin/activate
+python KZ.py build
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import fcntl
+import hashlib
+import subprocess
+import pandas as pd
+import sourmash
+from sourmash.signature import save_signatures_to_json
+
+MANIFEST_FILE = 'res/references.json'
+LOCK_FILE = 'res/references.lock.json'
+BUILD_LOCK = 'res/.references.build.lock'
+
+# Files that come with a reference, and files we derive from them during a build
+SOURCE_ARTIFACTS = ['fasta', 'genbank', 'ncbi', 'auspice_config']
+DERIVED_ARTIFACTS = ['fai', 'mmi', 'sketch']
+
+# Checksums already verified in this process, keyed by path -> (size, mtime, sha256)
+_validated = {}
+
+
+class ReferenceRegistry():
+
+    ######################################################################################################################
+    ## ---- CLASS START
+    def __init__(self, manifest_file=MANIFEST_FILE, lock_file=LOCK_FILE):
+        self.manifest_file = manifest_file
+        self.lock_file = lock_file
+
+        with open(self.manifest_file) as f:
+            manifest = json.load(f)
+        self.sketch_params = manifest['sketch_params']
+        self.references = manifest['references']
+
+        # samtools and bcftools only read <fasta>.fai, so the index path always follows the fasta
+        for name, entry in self.references.items():
+            fai = f"{entry['fasta']}.fai"
+            if entry.get('fai', fai) != fai:
+                raise Exception(f"Reference '{name}' sets fai to {entry['fai']}, but tools only read {fai}")
+            entry['fai'] = fai
+
+        if os.path.exists(self.lock_file):
+            with open(self.lock_file) as f:
+                self.lock = json.load(f)
+        else:
+            self.lock = {'references': {}}
+
+    def names(self):
+        return list(self.references.keys())
+
+    ######################################################################################################################
+    ## ---- LOOK UP A REFERENCE, CHECKING ITS ARTIFACTS AGAINST THE LOCK FILE
+    def get(self, name):
+        if name not in self.references:
+            raise Exception(f"Unknown reference '{name}', expected one of {self.names()} from {self.manifest_file}")
+
+        entry = self.references[name]
+        checksums = self.lock['references'].get(name)
+        if checksums is None:
+            raise Exception(f"Reference '{name}' has not been built, run `python KZ.py build {name}`")
+
+        for artifact in SOURCE_ARTIFACTS + DERIVED_ARTIFACTS:
+            path = entry[artifact]
+            if not os.path.exists(path):
+                raise Exception(f"Missing {artifact} file {path} for '{name}', run `python KZ.py build {name}`")
+            if self.checksum(path) != checksums.get(artifact):
+                raise Exception(f"Checksum mismatch on {path} for '{name}', run `python KZ.py build {name}`")
+
+        # Sketches built with other params can't be compared with ones sketched now
+        if checksums.get('sketch_params') != self.sketch_params:
+            raise Exception(f"Sketch params in {self.manifest_file} changed since '{name}' was built, run `python KZ.py build {name}`")
+
+        return entry
+
+    def checksum(self, path):
+        stat = os.stat(path)
+        cached = _validated.get(path)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+
+        _validated[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    ######################################################################################################################
+    ## ---- BUILD DERIVED ARTIFACTS (faidx, minimap2 index, baseline sketches) AND WRITE THE LOCK FILE
+    def build(self, names=None, force=False):
+        names = names or self.names()
+
+        # Only one build at a time, so concurrent builds never write the same index
+        with open(BUILD_LOCK, 'w') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+
+            # Re-read the lock, another build may have finished while we waited
+            if os.path.exists(self.lock_file):
+                with open(self.lock_file) as f:
+                    self.lock = json.load(f)
+
+            for name in names:
+                if name not in self.references:
+                    raise Exception(f"Unknown reference '{name}', expected one of {self.names()} from {self.manifest_file}")
+                entry = self.references[name]
+                old = self.lock['references'].get(name, {})
+
+                fasta_changed = old.get('fasta') != self.checksum(entry['fasta'])
+                ncbi_changed = old.get('ncbi') != self.checksum(entry['ncbi'])
+                params_changed = old.get('sketch_params') != self.sketch_params
+
+                if force or fasta_changed or not self.is_current(entry, old, 'fai'):
+                    print(f"{name}: indexing {entry['fasta']} with samtools faidx")
+                    self.build_fai(entry['fasta'], entry['fai'])
+                if force or fasta_changed or not self.is_current(entry, old, 'mmi'):
+                    print(f"{name}: building minimap2 index {entry['mmi']}")
+                    self.build_mmi(entry['fasta'], entry['mmi'])
+                if force or ncbi_changed or params_changed or not self.is_current(entry, old, 'sketch'):
+                    print(f"{name}: sketching NCBI panel into {entry['sketch']}")
+                    self.build_sketch(entry['ncbi'], entry['sketch'])
+
+                self.lock['references'][name] = {
+                    artifact: self.checksum(entry[artifact]) for artifact in SOURCE_ARTIFACTS + DERIVED_ARTIFACTS
+                }
+                self.lock['references'][name]['sketch_params'] = self.sketch_params
+
+            tmp_lock = f'{self.lock_file}.tmp'
+            with open(tmp_lock, 'w') as f:
+                json.dump(self.lock, f, indent=4, sort_keys=True)
+            os.replace(tmp_lock, self.lock_file)
+
+    def is_current(self, entry, old, artifact):
+        path = entry[artifact]
+        return os.path.exists(path) and old.get(artifact) == self.checksum(path)
+
+    # Each builder writes to a temporary file and moves it into place, so readers never see a partial index
+    def build_fai(self, fasta, fai):
+        subprocess.run(['samtools', 'faidx', fasta, '--fai-idx', f'{fai}.tmp'], check=True)
+        os.replace(f'{fai}.tmp', fai)
+
+    def build_mmi(self, fasta, mmi):
+        subprocess.run(['minimap2', '-d', f'{mmi}.tmp', fasta], check=True)
+        os.replace(f'{mmi}.tmp', mmi)
+
+    def build_sketch(self, ncbi, sketch):
+        ncbidata = pd.read_table(ncbi)
+        sigs = []
+        for _, row in ncbidata.iterrows():
+            mh = sourmash.MinHash(0, ksize=self.sketch_params['klen'], scaled=self.sketch_params['scale'],
+                                  track_abundance=self.sketch_params['abundance'])
+            mh.add_sequence(str(row['seq']), force=True)
+            sigs.append(sourmash.SourmashSignature(mh, name=str(row['name'])))
+
+        with open(f'{sketch}.tmp', 'wb') as f:
+            save_signatures_to_json(sigs, f, compression=1)
+        os.replace(f'{sketch}.tmp', sketch)
+
+    ######################################################################################################################
+    ## ---- LOAD BASELINE SKETCHES IN THE SAME ORDER AS THE NCBI TABLE
+    def load_sketches(self, entry, names):
+        by_name = {sig.name: sig.minhash for sig in sourmash.load_file_as_signatures(entry['sketch'])}
+        return [by_name[str(name)] for name in names]
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+# Host-wide settings, shared by every session and process that points at the same lease file
+LEASE_FILE = os.environ.get('KZ_LEASE_FILE', os.path.join(tempfile.gettempdir(), 'kz_cpu_leases.json'))
+CPU_BUDGET = int(os.environ.get('KZ_CPU_BUDGET', len(os.sched_getaffinity(0))))
+CPU_AFFINITY = os.environ.get('KZ_CPU_AFFINITY', '0') == '1'
+POLL_SECONDS = 0.5
+
+# Share of the CPU budget each stage asks for while other stages hold leases, a stage alone gets the whole budget
+STAGE_WEIGHTS = {
+    'minimap2':     0.5,
+    'augur_align':  0.5,
+    'augur_tree':   1.0,
+}
+
+
+class Lease():
+    def __init__(self, stage, threads, cpus, wait):
+        self.stage = stage
+        self.threads = threads
+        self.cpus = cpus
+        self.wait = wait
+
+    @property
+    def prefix(self):
+        # Command prefix pinning the tool to the leased cores, empty when affinity is off
+        if self.cpus:
+            return f"taskset -c {','.join(str(c) for c in self.cpus)} "
+        return ''
+
+
+class CPUScheduler():
+
+    ######################################################################################################################
+    ## ---- CLASS START
+    def __init__(self, budget=CPU_BUDGET, weights=STAGE_WEIGHTS, affinity=CPU_AFFINITY, lease_file=LEASE_FILE):
+        self.weights = weights
+        self.affinity = affinity
+        # With affinity every leased thread needs a core of its own
+        if self.affinity:
+            budget = min(budget, len(os.sched_getaffinity(0)))
+        self.budget = max(1, budget)
+        self.lease_file = lease_file
+        # Seconds each stage spent queued for CPUs, for reporting
+        self.waits = {}
+
+    def share(self, stage):
+        return max(1, min(self.budget, int(self.budget * self.weights.get(stage, 1.0))))
+
+    ######################################################################################################################
+    ## ---- LEASE THREADS FOR A STAGE, WAITING WHILE THE BUDGET IS EXHAUSTED
+    # A stage starts once at least half of its share is free and gets as much of its share as is free.
+    # Weights only apply under contention, when no other lease is held the stage gets the whole budget.
+    @contextmanager
+    def lease(self, stage):
+        share = self.share(stage)
+        needed = max(1, share // 2)
+        lease_id = uuid.uuid4().hex
+
+        start = time.monotonic()
+        while True:
+            with self.ledger() as leases:
+                in_use = sum(l['threads'] for l in leases.values())
+                free = self.budget - in_use
+                if self.affinity:
+                    # Leases from processes with a bigger budget may hold cores past ours
+                    free_cpus = self.pick_cpus(leases, self.budget)
+                    free = min(free, len(free_cpus))
+                if free >= needed:
+                    wanted = share if leases else self.budget
+                    threads = min(wanted, free)
+                    cpus = free_cpus[:threads] if self.affinity else []
+                    leases[lease_id] = {'pid': os.getpid(), 'stage': stage, 'threads': threads, 'cpus': cpus}
+                    break
+            time.sleep(POLL_SECONDS)
+
+        wait = time.monotonic() - start
+        self.waits[stage] = self.waits.get(stage, 0) + wait
+        try:
+            yield Lease(stage, threads, cpus, wait)
+        finally:
+            with self.ledger() as leases:
+                leases.pop(lease_id, None)
+
+    def pick_cpus(self, leases, threads):
+        taken = {c for l in leases.values() for c in l['cpus']}
+        free = [c for c in sorted(os.sched_getaffinity(0)) if c not in taken]
+        return free[:threads]
+
+    ######################################################################################################################
+    ## ---- SHARED LEASE FILE
+    @contextmanager
+    def ledger(self):
+        with open(f'{self.lease_file}.lock', 'w') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+
+            leases = {}
+            if os.path.exists(self.lease_file):
+                with open(self.lease_file) as f:
+                    try:
+                        leases = json.load(f)
+                    except json.JSONDecodeError:
+                        leases = {}
+
+            # Drop leases left behind by processes that have exited
+            leases = {k: l for k, l in leases.items() if self.pid_alive(l['pid'])}
+
+            yield leases
+
+            tmp_file = f'{self.lease_file}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(leases, f)
+            os.replace(tmp_file, self.lease_file)
+
+    def pid_alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True